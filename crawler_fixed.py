@@ -1,17 +1,27 @@
-import requests
+import asyncio
+import aiohttp
 import re
-import time
 import random
 import csv
+import sqlite3
+import time
+import zstandard
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from urllib.parse import urljoin, urlparse
 from datetime import datetime
+from functools import lru_cache
+from selectolax.lexbor import LexborHTMLParser
 
 MEDIA_EXTENSIONS = re.compile(r'\.(png|jpg|jpeg|gif|ico|css|js|svg|woff|woff2|ttf|eot|mp4|mp3|mov|avi)$', re.IGNORECASE)
+SAFE_NAME_RE = re.compile(r"[^a-zA-Z0-9_-]")
 
 class DailyMedCrawler:
     def __init__(self, output_dir="data",resume=False):
         self.base_url = "https://dailymed.nlm.nih.gov"
+        self.base_url_parsed = urlparse(self.base_url)
+        self.base_netloc = self.base_url_parsed.netloc
+        self.base_scheme_netloc = f"{self.base_url_parsed.scheme}://{self.base_netloc}"
         self.output_dir = Path(output_dir)
         self.html_dir = self.output_dir / "html"
         self.html_dir.mkdir(parents=True, exist_ok=True)
@@ -28,68 +38,130 @@ class DailyMedCrawler:
         self.sleep_min = 1.0
         self.sleep_max = 2.5
         self.max_retries = 3
+        self.max_page_size = 2 << 20
+        self.concurrency = 64
+        self.per_host_limit = 8
+        self.host_semaphores = {}
+        # pages are stored in one sqlite file per batch of 2000, a single
+        # writer thread owns the connections
+        self.batch_size = 2000
+        self.commit_every = 500
+        self.batch_dbs = {}
+        self.pending_writes = 0
+        self.compressor = zstandard.ZstdCompressor(level=3)
+        self.write_executor = ThreadPoolExecutor(max_workers=1)
 
         self.visited = set()
+        self.enqueued = set()
+        # URLs queued but not processed yet, in queue order, for save_state
+        self.pending = {}
         self.page_count = 0
+        # page_count // 100 of the last checkpoint, set right after the increment
+        # in save_html since workers interleave at every await
+        self.last_checkpoint = 0
+        self.checkpoint_due = False
 
         self.metadata_path = self.output_dir / "crawl_metadata.tsv"
         mode = "a" if (resume and self.metadata_path.exists()) else "w"
-        self.metadata_file = open(self.metadata_path, mode, newline="", encoding="utf-8")
+        self.metadata_file = open(self.metadata_path, mode, newline="", encoding="utf-8", buffering=1 << 16)
         self.metadata_writer = csv.writer(self.metadata_file, delimiter="\t")
         if mode == "w":
           self.metadata_writer.writerow(
               ["url", "status", "http_code", "retries", "saved_path", "scraped_at"]
           )
 
-    def fetch(self, url):
+    def get_host_semaphore(self, url):
+        netloc = urlparse(url).netloc
+        if netloc not in self.host_semaphores:
+            self.host_semaphores[netloc] = asyncio.Semaphore(self.per_host_limit)
+        return self.host_semaphores[netloc]
+
+    async def fetch(self, session, url):
         if url in self.visited:
             return None
 
         for attempt in range(1, self.max_retries + 1):
             delay = random.uniform(self.sleep_min, self.sleep_max)
-            time.sleep(delay)
 
             try:
-                print(f"[{self.page_count}] Fetching (attempt {attempt}): {url}")
-                response = requests.get(url, headers=self.headers, timeout=self.timeout)
-                response.raise_for_status()
+                async with self.get_host_semaphore(url):
+                    await asyncio.sleep(delay)
+                    print(f"[{self.page_count}] Fetching (attempt {attempt}): {url}")
+                    async with session.get(url, timeout=aiohttp.ClientTimeout(total=self.timeout)) as response:
+                        response.raise_for_status()
+                        html = await self.read_html(response)
                 self.visited.add(url)
 
+                if html is None:
+                    self.log_metadata(
+                        url=url,
+                        status="skipped",
+                        http_code=response.status,
+                        retries=attempt,
+                        saved_path="N/A",
+                    )
+                    return None
+
                 # Log successful fetch
                 self.log_metadata(
                     url=url,
                     status="success",
-                    http_code=response.status_code,
+                    http_code=response.status,
                     retries=attempt,
-                    saved_path=self.get_html_path(url).as_posix(),
+                    saved_path=self.get_batch_path().as_posix(),
                 )
-                return response.text
+                return html
 
-            except requests.RequestException as e:
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
                 print(f"ERROR fetching {url} (attempt {attempt}): {e}")
                 if attempt == self.max_retries:
                     # Log permanent failure
                     self.log_metadata(
                         url=url,
                         status="failed",
-                        http_code=getattr(e.response, "status_code", None),
+                        http_code=getattr(e, "status", None),
                         retries=attempt,
                         saved_path="N/A",
                     )
                     return None
                 
+    async def read_html(self, response):
+        # skip non-HTML responses and stop reading oversized ones early
+        if 'html' not in response.headers.get('Content-Type', ''):
+            return None
+        if (response.content_length or 0) > self.max_page_size:
+            return None
+
+        chunks = []
+        total = 0
+        async for chunk in response.content.iter_chunked(1 << 15):
+            total += len(chunk)
+            if total > self.max_page_size:
+                return None
+            chunks.append(chunk)
+        return b''.join(chunks).decode(response.charset or 'utf-8', errors='replace')
+
+    @staticmethod
+    @lru_cache(maxsize=65536)
+    def _is_media(suffix):
+        return bool(MEDIA_EXTENSIONS.search(suffix))
+
     def is_allowed_url(self,url_to_check):
-        return not MEDIA_EXTENSIONS.search(url_to_check)
-    def save_state(self, to_visit):
+        # the longest extension is ".woff2", so the last 10 chars are enough
+        return not self._is_media(url_to_check[-10:].lower())
+    def save_state(self):
         state = {
-            'to_visit': list(to_visit),
+            'to_visit': list(self.pending),
             'visited': list(self.visited),
+            'enqueued': list(self.enqueued),
             'page_count': self.page_count
         }
         state_path = self.output_dir / "crawler_state.json"
         import json
         with open(state_path, 'w') as f:
             json.dump(state, f, indent=2)
+        self.metadata_file.flush()
+        self.write_executor.submit(self.commit_pages)
         print(f"state saved to {state_path}")
 
     def load_state(self):
@@ -99,24 +171,27 @@ class DailyMedCrawler:
             with open(state_path, 'r') as f:
                 state = json.load(f)
             self.visited = set(state['visited'])
+            self.enqueued = set(state.get('enqueued', [])) | self.visited | set(state['to_visit'])
             self.page_count = state['page_count']
+            self.last_checkpoint = self.page_count // 100
             return state['to_visit']
         return None
 
     def extract_links(self, html, current_url):
-        links = re.findall(r'href\s*=\s*["\']([^"\']+)["\']', html, re.IGNORECASE)
+        tree = LexborHTMLParser(html)
         absolute_links = set()
     
-        for link in links:
-            if link.startswith(('javascript:', 'mailto:', 'tel:', '#', 'data:')):
+        for a in tree.css('a[href]'):
+            link = (a.attributes.get('href') or '').strip()
+            if not link or link.startswith(('javascript:', 'mailto:', 'tel:', '#', 'data:')):
                 continue
             
             try:
                 full_url = urljoin(current_url, link)
                 parsed = urlparse(full_url)
     
-                if parsed.netloc == urlparse(self.base_url).netloc:
-                  clean_url = parsed.scheme + "://" + parsed.netloc + parsed.path
+                if parsed.netloc == self.base_netloc:
+                  clean_url = self.base_scheme_netloc + parsed.path
                   if parsed.query:
                       clean_url += "?" + parsed.query
                   absolute_links.add(clean_url)
@@ -126,68 +201,165 @@ class DailyMedCrawler:
 
         return absolute_links
         
-    def get_html_path(self, url):
+    def get_page_name(self, url):
         parsed = urlparse(url)
         path_and_query = parsed.path
         
         if parsed.query:
             path_and_query += "?" + parsed.query
         
-        safe_name = re.sub(r"[^a-zA-Z0-9_-]", "_", path_and_query.strip("/")) or "index"
+        safe_name = SAFE_NAME_RE.sub("_", path_and_query.strip("/")) or "index"
 
         if len(safe_name) > 200:
             safe_name = safe_name[:200]
         
-        return self.html_dir / f"batch_{self.page_count//2000}"/ f"{safe_name}.html"
+        return f"{safe_name}.html"
+
+    def get_batch_path(self):
+        return self.html_dir / f"batch_{self.page_count // self.batch_size}.sqlite"
+
+    def get_batch_db(self, db_path):
+        conn = self.batch_dbs.get(db_path)
+        if conn is None:
+            # batches are filled in order, older ones won't be written again
+            self.close_batch_dbs()
+            conn = sqlite3.connect(db_path, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS pages("
+                "url TEXT PRIMARY KEY, name TEXT, html BLOB, fetched_at INTEGER)"
+            )
+            self.batch_dbs[db_path] = conn
+        return conn
 
-    def save_html(self, url, html):
-        path = self.get_html_path(url)
-        path.parent.mkdir(parents=True, exist_ok=True) 
-        path.write_text(html, encoding="utf-8")
+    def write_page(self, db_path, url, name, html):
+        conn = self.get_batch_db(db_path)
+        conn.execute(
+            "INSERT OR IGNORE INTO pages VALUES (?, ?, ?, ?)",
+            (url, name, self.compressor.compress(html.encode("utf-8")), int(time.time())),
+        )
+        self.pending_writes += 1
+        if self.pending_writes >= self.commit_every:
+            self.commit_pages()
+
+    def commit_pages(self):
+        for conn in self.batch_dbs.values():
+            conn.commit()
+        self.pending_writes = 0
+
+    def close_batch_dbs(self):
+        self.commit_pages()
+        for conn in self.batch_dbs.values():
+            conn.close()
+        self.batch_dbs = {}
+
+    async def save_html(self, url, html):
+        db_path = self.get_batch_path()
+        name = self.get_page_name(url)
         self.page_count += 1
-        print(f"saved HTML: {path.name}")
-        return path
+        if self.page_count // 100 > self.last_checkpoint:
+            self.last_checkpoint = self.page_count // 100
+            self.checkpoint_due = True
+        # disk writes run on the writer thread so they don't block the event loop
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self.write_executor, self.write_page, db_path, url, name, html)
+        print(f"saved HTML: {name}")
+        return db_path
 
     def log_metadata(self, url, status, http_code, retries, saved_path):
         self.metadata_writer.writerow(
             [url, status, http_code or "N/A", retries, saved_path, datetime.now().isoformat()]
         )
-        self.metadata_file.flush()
 
-    def crawl(self, start_url=None, max_pages=100,resume=False):
+    async def worker(self, session, to_visit, max_pages, done):
+        while True:
+            current_url = await to_visit.get()
+            try:
+                if len(self.visited) >= max_pages:
+                    to_visit.put_nowait(current_url)
+                    done.set()
+                    return
+
+                html = await self.fetch(session, current_url)
+                # a URL cancelled mid-fetch stays pending and is saved with the state
+                self.pending.pop(current_url, None)
+                if not html:
+                    continue
+
+                await self.save_html(current_url, html)
+                new_links = self.extract_links(html, current_url)
+
+                for link in new_links:
+                    if link not in self.enqueued and self.is_allowed_url(link):
+                        self.enqueued.add(link)
+                        self.pending[link] = None
+                        to_visit.put_nowait(link)
+
+                # saved once this page's links are queued
+                if self.checkpoint_due:
+                    self.checkpoint_due = False
+                    self.save_state()
+            except Exception as e:
+                # one bad page must not kill the worker, otherwise join() never returns
+                print(f"error processing {current_url}: {e!r}")
+                self.log_metadata(
+                    url=current_url,
+                    status="failed",
+                    http_code=None,
+                    retries=0,
+                    saved_path="N/A",
+                )
+            finally:
+                to_visit.task_done()
+
+    async def crawl(self, start_url=None, max_pages=100,resume=False):
         if start_url is None:
             start_url = self.base_url
 
+        start_urls = None
         if resume:
-            to_visit = self.load_state()
-            if to_visit:
-                print(f"resuming crawl with {len(to_visit)} URLs in queue")
-            else:
-                to_visit = [start_url]
-        else:
-            to_visit = [start_url]
+            start_urls = self.load_state()
+            if start_urls:
+                print(f"resuming crawl with {len(start_urls)} URLs in queue")
+        if not start_urls:
+            start_urls = [start_url]
+
+        to_visit = asyncio.Queue()
+        for url in start_urls:
+            self.enqueued.add(url)
+            self.pending[url] = None
+            to_visit.put_nowait(url)
         max_pages = 2000000
-        while to_visit and len(self.visited) < max_pages:
-            current_url = to_visit.pop(0)
-            html = self.fetch(current_url)
-            if not html:
-                continue
 
-            self.save_html(current_url, html)
-            new_links = self.extract_links(html, current_url)
+        done = asyncio.Event()
+        # pooled keep-alive connections, reused across workers
+        connector = aiohttp.TCPConnector(
+            limit=self.concurrency,
+            limit_per_host=self.per_host_limit,
+            ttl_dns_cache=300,
+            keepalive_timeout=60,
+        )
+        async with aiohttp.ClientSession(connector=connector, headers=self.headers) as session:
+            workers = [
+                asyncio.create_task(self.worker(session, to_visit, max_pages, done))
+                for _ in range(self.concurrency)
+            ]
+            finished = asyncio.create_task(to_visit.join())
+            stopped = asyncio.create_task(done.wait())
+            await asyncio.wait([finished, stopped], return_when=asyncio.FIRST_COMPLETED)
 
-            for link in new_links:
-                if link not in self.visited and link not in to_visit and self.is_allowed_url(link):
-                    to_visit.append(link)
-            
-            if self.page_count % 100 == 0:
-                self.save_state(to_visit)
+            for task in workers + [finished, stopped]:
+                task.cancel()
+            await asyncio.gather(*workers, finished, stopped, return_exceptions=True)
 
         # Final save
-        self.save_state(to_visit)
+        self.save_state()
         print(f"Crawl complete - fetched {self.page_count} pages.")
 
     def close(self):
+        self.write_executor.submit(self.close_batch_dbs)
+        self.write_executor.shutdown(wait=True)
         self.metadata_file.close()
 
 
@@ -195,7 +367,7 @@ def main():
     resume = False
     crawler = DailyMedCrawler(resume=resume)
     try:
-        crawler.crawl(max_pages=20, resume=resume)
+        asyncio.run(crawler.crawl(max_pages=20, resume=resume))
     finally:
         crawler.close()
 
@@ -1,136 +1,347 @@
+import array
 import csv
 import re
 import json
-from collections import defaultdict, Counter
+from collections import Counter
+import os
+import multiprocessing
+import msgpack
+import numpy as np
+from scipy.sparse import csr_matrix
 import tiktoken
+import zstandard
 
-class DrugTFIDFIndexer:
-    def __init__(self):
-        self.index = defaultdict(dict)
-        self.doc_count = 0
-        self.doc_lengths = {}
-        self.drugs = {}
+DOSAGE_PATTERN = r'\b\d+(?:\.\d+)?\s*(?:mg|mcg|g|ml|mcl|ug|iu|units?)\b(?:/\w+)?'
 
-        self.GENERAL_STOPWORDS = {
-            'the', 'a', 'an', 'and', 'or', 'but', 'in', 'on', 'at', 'to', 
-            'for', 'of', 'with', 'by', 'from', 'as', 'is', 'was', 'are', 
-            'were', 'been', 'be', 'have', 'has', 'had', 'do', 'does', 'did',
-            'will', 'would', 'should', 'could', 'may', 'might', 'can', 'this',
-            'that', 'these', 'those', 'it', 'its', 'you', 'your', 'not', 'who','any'
-        }
-        
-        self.DOMAIN_STOPWORDS = {
-            'drug', 'drugs', 'medicine', 'medication', 'medications',
-            'treatment', 'pharmaceutical', 'therapy', 'oral', 'patient', 
-            'patients', 'may', 'should', 'can', 'use', 'used', 'using'
-        }
-        
-        self.ALL_STOPWORDS = self.GENERAL_STOPWORDS | self.DOMAIN_STOPWORDS
+# single pass tokenizer, alternation order matters: dosages win over
+# percentages/words, compounds over plain words. A percentage directly
+# followed by a dosage is skipped, like it was when dosages were masked out
+TOKEN_RE = re.compile(
+    rf'(?P<dosage>{DOSAGE_PATTERN})'
+    r'|(?P<compound>\b[a-z]+(?:-[a-z]+)+\b)'
+    rf'|(?P<pct>\b\d+(?:\.\d+)?%\b(?!{DOSAGE_PATTERN}))'
+    r'|(?P<word>\b[a-z]{3,}\b)'
+)
+SPACE_RE = re.compile(r'\s+')
+
+# dtypes of the CSR arrays as they are stored on disk
+# tf counts are stored as uint8, anything past 255 is clipped when the index is built
+INDEX_ARRAYS = {'indptr': np.int64, 'indices': np.int32, 'data': np.uint8}
+MAX_TF = 255
+
+GENERAL_STOPWORDS = frozenset({
+    'the', 'a', 'an', 'and', 'or', 'but', 'in', 'on', 'at', 'to', 
+    'for', 'of', 'with', 'by', 'from', 'as', 'is', 'was', 'are', 
+    'were', 'been', 'be', 'have', 'has', 'had', 'do', 'does', 'did',
+    'will', 'would', 'should', 'could', 'may', 'might', 'can', 'this',
+    'that', 'these', 'those', 'it', 'its', 'you', 'your', 'not', 'who','any'
+})
+
+DOMAIN_STOPWORDS = frozenset({
+    'drug', 'drugs', 'medicine', 'medication', 'medications',
+    'treatment', 'pharmaceutical', 'therapy', 'oral', 'patient', 
+    'patients', 'may', 'should', 'can', 'use', 'used', 'using'
+})
+
+ALL_STOPWORDS = GENERAL_STOPWORDS | DOMAIN_STOPWORDS
+
+
+def tokenize(text):
+    if not text or text == 'Not found':
+        return []
+
+    tokens = []
+    for match in TOKEN_RE.finditer(text.lower()):
+        kind = match.lastgroup
+        token = match.group(kind)
+
+        if kind == 'dosage':
+            tokens.append(SPACE_RE.sub('', token))
+
+        elif kind == 'word':
+            if token not in ALL_STOPWORDS:
+                tokens.append(token)
+
+        else:
+            tokens.append(token)
+            # the parts of a compound are also indexed as plain words
+            if kind == 'compound':
+                tokens.extend(
+                    part for part in token.split('-')
+                    if len(part) > 2 and part not in ALL_STOPWORDS
+                )
     
-    def tokenize(self, text):
-        if not text or text == 'Not found':
-            return []
+    return tokens
 
-        text = text.lower()
-        
-        tokens = []
 
-        dosage_pattern = r'\b\d+(?:\.\d+)?\s*(?:mg|mcg|g|ml|mcl|ug|iu|units?)\b(?:/\w+)?'
-        dosages = re.findall(dosage_pattern, text)
+DEFAULT_FIELD_WEIGHTS = {
+    'drug_name': 5,           
+    'active_ingredients': 3,   
+    'indications_and_usage': 4,
+    'inactive_ingredients': 1,
+    'contraindications': 1,   
+    'warnings': 1              
+}
 
-        dosages = [re.sub(r'\s+', '', d) for d in dosages]
-        tokens.extend(dosages)
 
-        text = re.sub(dosage_pattern, ' ', text)
+def create_document_text(drug_record, field_weights=None):
 
-        compound_pattern = r'\b[a-z]+(?:-[a-z]+)+\b'
-        compounds = re.findall(compound_pattern, text)
-        tokens.extend(compounds)
-        
-        percentages = re.findall(r'\b\d+(?:\.\d+)?%\b', text)
-        tokens.extend(percentages)
+    if field_weights is None:
+        field_weights = DEFAULT_FIELD_WEIGHTS
+    
+    text_parts = []
+    for field, weight in field_weights.items():
+        value = drug_record.get(field, '')
+        if value and value != 'Not found':
+            text_parts.extend([str(value)] * weight)
+    
+    return ' '.join(text_parts)
 
-        words = re.findall(r'\b[a-z]{3,}\b', text)
-        tokens.extend(words)
 
-        filtered_tokens = []
-        for token in tokens:
+def count_terms(tokens):
+    # unique terms and their counts as an int array ready for the postings buffer
+    term_counts = Counter(tokens)
+    return list(term_counts), np.fromiter(term_counts.values(), dtype=np.intc, count=len(term_counts))
 
-            if any(char.isdigit() for char in token) or '-' in token or '%' in token:
-                filtered_tokens.append(token)
 
-            elif token not in self.ALL_STOPWORDS and len(token) > 2:
-                filtered_tokens.append(token)
-        
-        return filtered_tokens
+# column positions of the TSV header, set in each Pool worker by _init_worker
+_SETID_COLUMN = None
+_FIELD_COLUMNS = None
+
+
+def _init_worker(header):
+    global _SETID_COLUMN, _FIELD_COLUMNS
+    col_idx = {name: i for i, name in enumerate(header)}
+    _SETID_COLUMN = col_idx['setid']
+    _FIELD_COLUMNS = {field: col_idx[field] for field in DEFAULT_FIELD_WEIGHTS if field in col_idx}
+
+
+def _tokenize_row(row):
+    # runs in Pool workers, keep it free of indexer state. rows are plain
+    # lists so only the values get pickled, not a dict of keys per row
+    record = {field: row[i] if i < len(row) else '' for field, i in _FIELD_COLUMNS.items()}
+    tokens = tokenize(create_document_text(record))
+    terms, counts = count_terms(tokens)
+    return row[_SETID_COLUMN], terms, counts, len(tokens)
+
+
+class DrugTFIDFIndexer:
+    def __init__(self):
+        # postings live in a term x doc CSR matrix of term counts, terms and
+        # setids are mapped to row/column numbers
+        self.vocab = {}
+        self.terms = []
+        self.doc_index = {}
+        self.doc_ids = []
+        self.tf = csr_matrix((0, 0), dtype=np.uint8)
+        self.doc_count = 0
+        self.doc_lengths = {}
+        self.drugs = {}
+
+        self.GENERAL_STOPWORDS = GENERAL_STOPWORDS
+        self.DOMAIN_STOPWORDS = DOMAIN_STOPWORDS
+        self.ALL_STOPWORDS = ALL_STOPWORDS
+
+        # (term id, doc id, count) triples collected until finalize()
+        self._term_buf = array.array('i')
+        self._doc_buf = array.array('i')
+        self._count_buf = array.array('i')
+        # doc id -> buffer offset of its latest row, for setids seen twice
+        self._replaced = {}
+        self._dirty = False
+    
+    def tokenize(self, text):
+        return tokenize(text)
     
     def create_document_text(self, drug_record, field_weights=None):
-
-        if field_weights is None:
-            field_weights = {
-                'drug_name': 5,           
-                'active_ingredients': 3,   
-                'indications_and_usage': 4,
-                'inactive_ingredients': 1,
-                'contraindications': 1,   
-                'warnings': 1              
-            }
+        return create_document_text(drug_record, field_weights)
+    
+    def add_document(self, doc_id, text):
+        tokens = tokenize(text)
+        terms, counts = count_terms(tokens)
+        self._add_postings(doc_id, terms, counts, len(tokens))
+    
+    def _add_postings(self, doc_id, terms, counts, length):
+        doc_idx = self.doc_index.get(doc_id)
+        if doc_idx is None:
+            doc_idx = self.doc_index[doc_id] = len(self.doc_ids)
+            self.doc_ids.append(doc_id)
+            self.doc_count += 1
+        else:
+            # a repeated setid replaces the postings of the earlier row
+            self._replaced[doc_idx] = len(self._doc_buf)
+        
+        term_ids = []
+        for term in terms:
+            term_id = self.vocab.get(term)
+            if term_id is None:
+                term_id = self.vocab[term] = len(self.terms)
+                self.terms.append(term)
+            term_ids.append(term_id)
         
-        text_parts = []
-        for field, weight in field_weights.items():
-            value = drug_record.get(field, '')
-            if value and value != 'Not found':
-                text_parts.extend([str(value)] * weight)
+        self._term_buf.extend(term_ids)
+        self._doc_buf.extend([doc_idx] * len(term_ids))
+        self._count_buf.frombytes(counts.tobytes())
         
-        return ' '.join(text_parts)
+        self.doc_lengths[doc_id] = length
+        self._dirty = True
     
-    def add_document(self, doc_id, text):
-        tokens = self.tokenize(text)
-        term_counts = Counter(tokens)
+    def finalize(self):
+        if not self._dirty:
+            return
         
-        for term, count in term_counts.items():
-            self.index[term][doc_id] = count
+        shape = (len(self.terms), len(self.doc_ids))
+        term_buf = np.asarray(self._term_buf)
+        doc_buf = np.asarray(self._doc_buf)
+        count_buf = np.asarray(self._count_buf)
+        if self._replaced:
+            # keep only the latest row of each repeated setid, coo -> csr
+            # would otherwise sum the counts of every row
+            start = np.zeros(shape[1], dtype=np.int64)
+            start[list(self._replaced)] = list(self._replaced.values())
+            keep = np.arange(len(doc_buf)) >= start[doc_buf]
+            term_buf, doc_buf, count_buf = term_buf[keep], doc_buf[keep], count_buf[keep]
+        tf = csr_matrix((count_buf, (term_buf, doc_buf)), shape=shape, dtype=np.int32)
+        if self.tf.nnz:
+            self.tf.resize(shape)
+            old = self.tf.astype(np.int32)
+            if self._replaced:
+                old.data[np.isin(old.indices, list(self._replaced))] = 0
+                old.eliminate_zeros()
+            tf = old + tf
+        tf.sort_indices()
+        np.minimum(tf.data, MAX_TF, out=tf.data)
+        self.tf = tf.astype(np.uint8)
         
-        self.doc_lengths[doc_id] = len(tokens)
-        self.doc_count += 1
+        self._term_buf = array.array('i')
+        self._doc_buf = array.array('i')
+        self._count_buf = array.array('i')
+        self._replaced = {}
+        self._dirty = False
+    
+    def postings(self, term):
+        self.finalize()
+        term_id = self.vocab.get(term)
+        if term_id is None:
+            return np.empty(0, dtype=np.int32), np.empty(0, dtype=np.uint8)
+        start, end = self.tf.indptr[term_id], self.tf.indptr[term_id + 1]
+        return self.tf.indices[start:end], self.tf.data[start:end]
+    
+    def document_frequency(self, term):
+        self.finalize()
+        term_id = self.vocab.get(term)
+        if term_id is None:
+            return 0
+        return int(self.tf.indptr[term_id + 1] - self.tf.indptr[term_id])
     
     def load_from_tsv(self, tsv_path):
         
-        with open(tsv_path, 'r', encoding='utf-8') as f:
-            reader = csv.DictReader(f, delimiter='\t')
-            
-            for i, row in enumerate(reader):
-                setid = row['setid']
-                self.drugs[setid] = row
-                doc_text = self.create_document_text(row)
-                self.add_document(setid, doc_text)
+        # csv.reader rather than str.split, the parser quotes fields with tabs or newlines
+        with open(tsv_path, 'r', encoding='utf-8', buffering=1 << 20) as f:
+            reader = csv.reader(f, delimiter='\t')
+            header = next(reader)
+            rows = list(reader)
+        
+        setid_idx = header.index('setid')
+        for row in rows:
+            self.drugs[row[setid_idx]] = dict(zip(header, row))
+        
+        with multiprocessing.Pool(processes=os.cpu_count(), initializer=_init_worker, initargs=(header,)) as pool:
+            # ordered results keep doc columns, and so tie-breaking, in file order
+            results = pool.imap(_tokenize_row, rows, chunksize=256)
+            for i, (setid, terms, counts, length) in enumerate(results):
+                self._add_postings(setid, terms, counts, length)
                 
                 if (i + 1) % 1000 == 0:
                     print(f"  Indexed {i + 1} drugs...")
         
+        self.finalize()
         print(f"\n Indexed {self.doc_count} drugs")
-        print(f"Index contains {len(self.index)} unique terms")
-    
-    def save_index(self, output_path):
-        data = {
-            'index': {term: dict(docs) for term, docs in self.index.items()},
-            'doc_count': self.doc_count,
-            'doc_lengths': self.doc_lengths,
-            'drugs': self.drugs
+        print(f"Index contains {len(self.terms)} unique terms")
+    
+    def save_index(self, output_path, as_json=False):
+        self.finalize()
+        fields = ['terms', 'doc_ids', 'doc_count', 'doc_lengths']
+        arrays = {
+            name: getattr(self.tf, name).astype(dtype, copy=False)
+            for name, dtype in INDEX_ARRAYS.items()
         }
         
-        with open(output_path, 'w', encoding='utf-8') as f:
-            json.dump(data, f, indent=2)
+        # JSON is only kept around for debugging, msgpack+zstd is the default
+        if as_json:
+            data = {field: getattr(self, field) for field in fields}
+            data.update({name: values.tolist() for name, values in arrays.items()})
+            data['drugs'] = self.drugs
+            with open(output_path, 'w', encoding='utf-8') as f:
+                json.dump(data, f, indent=2)
+        else:
+            # pack and compress piece by piece so no second copy of the
+            # index is built in memory
+            cctx = zstandard.ZstdCompressor(level=3)
+            packer = msgpack.Packer(use_bin_type=True)
+            with open(output_path, 'wb') as f, cctx.stream_writer(f) as out:
+                out.write(packer.pack_map_header(len(fields) + len(arrays) + 1))
+                for field in fields:
+                    out.write(packer.pack(field))
+                    out.write(packer.pack(getattr(self, field)))
+                for name, values in arrays.items():
+                    out.write(packer.pack(name))
+                    out.write(packer.pack(memoryview(values)))
+                out.write(packer.pack('drugs'))
+                out.write(packer.pack_map_header(len(self.drugs)))
+                for setid, drug in self.drugs.items():
+                    out.write(packer.pack(setid))
+                    out.write(packer.pack(drug))
         
         print(f"Index saved to {output_path}")
     
-    def load_index(self, input_path):
-        with open(input_path, 'r', encoding='utf-8') as f:
-            data = json.load(f)
+    def save_index_mmap(self, output_dir):
+        # arrays as plain .npy files so they can be memory mapped on load
+        self.finalize()
+        os.makedirs(output_dir, exist_ok=True)
+        for name, dtype in INDEX_ARRAYS.items():
+            np.save(os.path.join(output_dir, f"{name}.npy"), getattr(self.tf, name).astype(dtype, copy=False))
+        
+        meta = {field: getattr(self, field) for field in ['terms', 'doc_ids', 'doc_count', 'doc_lengths', 'drugs']}
+        cctx = zstandard.ZstdCompressor(level=3)
+        with open(os.path.join(output_dir, 'meta.msgpack.zst'), 'wb') as f:
+            f.write(cctx.compress(msgpack.packb(meta, use_bin_type=True)))
+        
+        print(f"Index saved to {output_dir}")
+    
+    def load_index_mmap(self, input_dir):
+        dctx = zstandard.ZstdDecompressor()
+        with open(os.path.join(input_dir, 'meta.msgpack.zst'), 'rb') as f:
+            data = msgpack.unpackb(dctx.decompress(f.read()), raw=False)
+        # postings stay on disk, pages are read in as searches touch them
+        arrays = {name: np.load(os.path.join(input_dir, f"{name}.npy"), mmap_mode='r') for name in INDEX_ARRAYS}
+        self._set_index(data, arrays)
+    
+    def load_index(self, input_path, as_json=False):
+        if as_json:
+            with open(input_path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        else:
+            dctx = zstandard.ZstdDecompressor()
+            with open(input_path, 'rb') as f:
+                data = msgpack.unpackb(dctx.stream_reader(f).read(), raw=False)
         
-        self.index = defaultdict(dict, {
-            term: docs for term, docs in data['index'].items()
-        })
+        if as_json:
+            arrays = {name: np.asarray(data[name], dtype=dtype) for name, dtype in INDEX_ARRAYS.items()}
+        else:
+            arrays = {name: np.frombuffer(data[name], dtype=dtype) for name, dtype in INDEX_ARRAYS.items()}
+        self._set_index(data, arrays)
+    
+    def _set_index(self, data, arrays):
+        self.terms = data['terms']
+        self.doc_ids = data['doc_ids']
+        self.vocab = {term: i for i, term in enumerate(self.terms)}
+        self.doc_index = {doc_id: i for i, doc_id in enumerate(self.doc_ids)}
+        self.tf = csr_matrix(
+            (arrays['data'], arrays['indices'], arrays['indptr']),
+            shape=(len(self.terms), len(self.doc_ids))
+        )
+        self._dirty = False
         self.doc_count = data['doc_count']
         self.doc_lengths = data['doc_lengths']
         self.drugs = data['drugs']
@@ -138,21 +349,22 @@ class DrugTFIDFIndexer:
         print(f"Loaded index with {self.doc_count} documents")
     
     def get_statistics(self):
+        self.finalize()
         total_tokens = sum(self.doc_lengths.values())
         avg_doc_length = total_tokens / self.doc_count if self.doc_count > 0 else 0
 
-        term_doc_counts = {
-            term: len(docs) for term, docs in self.index.items()
-        }
-        most_common = sorted(
-            term_doc_counts.items(), 
-            key=lambda x: x[1], 
-            reverse=True
-        )[:20]
+        doc_freqs = np.diff(self.tf.indptr)
+        # partition out the top 20 (and anything tied with the 20th) before sorting
+        top = np.arange(doc_freqs.size)
+        if doc_freqs.size > 20:
+            kth = np.partition(doc_freqs, -20)[-20]
+            top = np.flatnonzero(doc_freqs >= kth)
+        top = top[np.argsort(-doc_freqs[top], kind='stable')][:20]
+        most_common = [(self.terms[i], int(doc_freqs[i])) for i in top]
         
         stats = {
             'total_documents': self.doc_count,
-            'unique_terms': len(self.index),
+            'unique_terms': len(self.terms),
             'total_tokens': total_tokens,
             'avg_document_length': avg_doc_length,
             'most_common_terms': most_common
@@ -164,20 +376,19 @@ class DrugTFIDFIndexer:
         
         encoding = tiktoken.get_encoding("cl100k_base")
         
-        total_tiktoken_tokens = 0
-
-        for i, (setid, drug) in enumerate(self.drugs.items()):
-            doc_text = self.create_document_text(drug, field_weights={
-                'drug_name': 1,
-                'active_ingredients': 1,
-                'inactive_ingredients': 1,
-                'indications_and_usage': 1,
-                'contraindications': 1,
-                'warnings': 1
-            })
-            
-            tokens = encoding.encode(doc_text)
-            total_tiktoken_tokens += len(tokens)
+        field_weights = {
+            'drug_name': 1,
+            'active_ingredients': 1,
+            'inactive_ingredients': 1,
+            'indications_and_usage': 1,
+            'contraindications': 1,
+            'warnings': 1
+        }
+        texts = [create_document_text(drug, field_weights=field_weights) for drug in self.drugs.values()]
+        
+        # batch encoding runs on tiktoken's Rust thread pool without the GIL
+        token_lists = encoding.encode_ordinary_batch(texts, num_threads=os.cpu_count())
+        total_tiktoken_tokens = sum(map(len, token_lists))
     
         return {
             'total_tiktoken_tokens': total_tiktoken_tokens,
@@ -203,10 +414,11 @@ def main():
 
     indexer = DrugTFIDFIndexer()
     indexer.load_from_tsv('data/drugs.tsv')
-    indexer.load_index('data/drug_index.json')
+    indexer.load_index('data/drug_index.msgpack.zst')
     indexer.print_statistics()
     print(indexer.get_tiktoken_statistics())
-    indexer.save_index('data/drug_index.json')
+    indexer.save_index('data/drug_index.msgpack.zst')
+    indexer.save_index_mmap('data/drug_index')
 
 if __name__ == "__main__":
     main()
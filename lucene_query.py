@@ -0,0 +1,85 @@
+from java.lang import Float
+from org.apache.lucene.analysis.tokenattributes import CharTermAttribute
+from org.apache.lucene.index import FieldInfos, Term
+from org.apache.lucene.search import BooleanQuery, BooleanClause, BoostQuery, FuzzyQuery, SynonymQuery
+from org.apache.lucene.queryparser.classic import QueryParser, MultiFieldQueryParser
+from rapidfuzz import process
+from rapidfuzz.distance import OSA
+import threading
+
+FUZZY_PREFIX_LENGTH = 2
+# FuzzyQuery's default cap on the terms one fuzzy term expands to
+FUZZY_MAX_EXPANSIONS = 50
+
+
+class QueryParsers(threading.local):
+    def __init__(self, fields, analyzer, boosts):
+        # the classic QueryParser is not thread-safe. threading.local reruns this
+        # in every thread that touches the object, so each thread gets its own pair
+        self.and_parser = MultiFieldQueryParser(fields, analyzer, boosts)
+        self.and_parser.setDefaultOperator(QueryParser.Operator.AND)
+        self.or_parser = MultiFieldQueryParser(fields, analyzer, boosts)
+        self.or_parser.setDefaultOperator(QueryParser.Operator.OR)
+
+
+def has_group_field(reader):
+    # indexes built before drug_name_group existed put every hit in one null group
+    return FieldInfos.getMergedFieldInfos(reader).fieldInfo("drug_name_group") is not None
+
+
+def analyze_terms(analyzer, field, text):
+    stream = analyzer.tokenStream(field, text)
+    term_attr = stream.addAttribute(CharTermAttribute.class_)
+    terms = []
+    try:
+        stream.reset()
+        while stream.incrementToken():
+            terms.append(term_attr.toString())
+        stream.end()
+    finally:
+        stream.close()
+    return terms
+
+
+class FuzzyTermIndex:
+    def __init__(self, words=()):
+        # FuzzyQuery needs the first FUZZY_PREFIX_LENGTH characters to match exactly,
+        # so only terms sharing the query term's prefix are ever compared
+        self.buckets = {}
+        for word in words:
+            self.buckets.setdefault(word[:FUZZY_PREFIX_LENGTH], []).append(word)
+
+    def find(self, word, max_edits):
+        # (term, distance) pairs, closest first. osa is the distance FuzzyQuery
+        # computes with transpositions on
+        bucket = self.buckets.get(word[:FUZZY_PREFIX_LENGTH], ())
+        matches = process.extract(word, bucket, scorer=OSA.distance, score_cutoff=max_edits,
+                                  limit=FUZZY_MAX_EXPANSIONS)
+        return [(match, distance) for match, distance, _ in matches]
+
+
+def build_fuzzy_query(analyzer, query_str, fields, boosts, occur, name_terms=None):
+    # each query term has to fuzzily match at least one field, fields are boosted
+    builder = BooleanQuery.Builder()
+    for term in analyze_terms(analyzer, fields[0], query_str):
+        # same edit budget as the parser's fuzzy min similarity of 0.7
+        max_edits = min(int(0.3 * len(term)), 2)
+        term_builder = BooleanQuery.Builder()
+        for field in fields:
+            boost = Float.cast_(boosts.get(field)).floatValue()
+            if field == "drug_name" and name_terms is not None:
+                # drug name candidates are found in python. like FuzzyQuery's rewrite,
+                # each is weighted by its similarity and a SynonymQuery blends their
+                # document frequencies, so a rare misspelling can't outscore the real name
+                candidates = name_terms.find(term, max_edits)
+                if candidates:
+                    synonyms = SynonymQuery.Builder(field)
+                    for candidate, distance in candidates:
+                        similarity = 1.0 - distance / min(len(term), len(candidate))
+                        synonyms.addTerm(Term(field, candidate), similarity)
+                    term_builder.add(BoostQuery(synonyms.build(), boost), BooleanClause.Occur.SHOULD)
+                continue
+            fuzzy = FuzzyQuery(Term(field, term), max_edits, FUZZY_PREFIX_LENGTH)
+            term_builder.add(BoostQuery(fuzzy, boost), BooleanClause.Occur.SHOULD)
+        builder.add(term_builder.build(), occur)
+    return builder.build()
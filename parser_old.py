@@ -2,13 +2,240 @@ import re
 import csv
 from pathlib import Path
 import os
+import sqlite3
+import zstandard
+from concurrent.futures import ProcessPoolExecutor
+from selectolax.lexbor import LexborHTMLParser
+
+# selectolax is the default, set to False to go back to the regex extractors
+USE_SELECTOLAX = True
+
+STRENGTH_TEXT_RE = re.compile(
+    r'\d+(?:[.,]\d+)?[\u00A0\s]*[a-zA-Zμµu]+'
+    r'(?:\s*(?:/|per|in)\s*\d*(?:[.,]\d+)?[\u00A0\s]*[a-zA-Zμµu]*)?',
+    re.IGNORECASE
+)
+WS_RE = re.compile(r'\s+')
+
+
+def extract_text_between(html, start_pattern, end_pattern):
+    match = re.search(f'{start_pattern}(.*?){end_pattern}', html, re.DOTALL | re.IGNORECASE)
+    if match:
+        text = match.group(1)
+        text = re.sub(r'<[^>]+>', ' ', text)
+        text = re.sub(r'\s+', ' ', text).strip()
+        return text[:5000]
+    return ''
+
+
+def extract_table_ingredients(html, heading_text):
+    tables = re.findall(
+        r'<table[^>]*class="formTablePetite"[^>]*>.*?</table>',
+        html, re.DOTALL | re.IGNORECASE
+    )
+
+    table_html = ''
+    for t in tables:
+        if re.search(re.escape(heading_text), t, re.IGNORECASE):
+            table_html = t
+            break
+    if not table_html:
+        return ''
+
+    ingredient_pattern = r'<td class="formItem"><strong>([^<]+)</strong>'
+    ingredients = re.findall(ingredient_pattern, table_html, re.DOTALL | re.IGNORECASE)
+    ingredients = [re.sub(r'\s+', ' ', i.strip()) for i in ingredients]
+
+    if heading_text.lower() == "active ingredient/active moiety".lower():
+        strength_pattern = (
+            r'<td[^>]*class="formItem"[^>]*>\s*'
+            r'((?:\d+(?:[.,]\d+)?[\u00A0\s]*[a-zA-Zμµu]+'
+            r'(?:\s*(?:/|per|in)\s*\d*(?:[.,]\d+)?[\u00A0\s]*[a-zA-Zμµu]*)?)?)'
+            r'\s*</td>'
+        )
+        strengths = re.findall(strength_pattern, table_html, re.DOTALL | re.IGNORECASE)
+        strengths = [re.sub(r'\s+', ' ', s.strip().lower()) for s in strengths if s.strip()]
+
+        combined = []
+        for i, ing in enumerate(ingredients):
+            strength = strengths[i] if i < len(strengths) else ''
+            combined.append(f"{ing} ({strength})" if strength else ing)
+
+        return ', '.join(combined)
+
+    return ', '.join(ingredients)
+
+
+def extract_by_section_code(html, section_code):
+
+    pattern = rf'<div[^>]*data-sectioncode="{section_code}"[^>]*>(.*?)</div>\s*</li>'
+    match = re.search(pattern, html, re.DOTALL | re.IGNORECASE)
+    if match:
+        text = match.group(1)
+        text = re.sub(r'<[^>]+>', ' ', text) 
+        text = re.sub(r'\s+', ' ', text).strip()
+        return text
+    return ''
+
+
+def get_setid(html,filename):
+    file_components = filename.split("_")
+    if "setid" in file_components:
+        setid = file_components[file_components.index("setid")+1]
+        return setid.split(".")[0]
+    else:
+        setid = re.search(r'setid=([0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12})', html)
+        if setid:
+            setid = setid.group(1)
+            return setid
+
+
+def extract_product_type(html):
+    pattern = (
+        r'<td[^>]*class="formLabel"[^>]*>\s*Product\s*Type\s*</td>\s*'
+        r'<td[^>]*class="formItem"[^>]*>\s*([^<]+)\s*</td>'
+    )
+    match = re.search(pattern, html, re.DOTALL | re.IGNORECASE)
+    if match:
+        product_type = match.group(1)
+        product_type = re.sub(r'\s+', ' ', product_type).strip().lower()
+        return product_type
+    return ''
+
+
+def extract_table_ingredients_tree(tree, heading_text):
+    heading = heading_text.lower()
+    table = None
+    for t in tree.css('table.formTablePetite'):
+        if heading in t.html.lower():
+            table = t
+            break
+    if table is None:
+        return ''
+
+    ingredients = [WS_RE.sub(' ', node.text().strip()) for node in table.css('td.formItem > strong')]
+
+    if heading == "active ingredient/active moiety":
+        strengths = []
+        for td in table.css('td.formItem'):
+            # strength cells hold plain text only
+            if next(td.iter(), None) is not None:
+                continue
+            text = td.text().strip()
+            if text and STRENGTH_TEXT_RE.fullmatch(text):
+                strengths.append(WS_RE.sub(' ', text.lower()))
+
+        combined = []
+        for i, ing in enumerate(ingredients):
+            strength = strengths[i] if i < len(strengths) else ''
+            combined.append(f"{ing} ({strength})" if strength else ing)
+
+        return ', '.join(combined)
+
+    return ', '.join(ingredients)
+
+
+def extract_by_section_code_tree(tree, section_code):
+    div = tree.css_first(f'div[data-sectioncode="{section_code}"]')
+    if div is None:
+        return ''
+    return WS_RE.sub(' ', div.text(separator=' ')).strip()
+
+
+def extract_product_type_tree(tree):
+    for td in tree.css('td.formLabel'):
+        if ''.join(td.text().split()).lower() != 'producttype':
+            continue
+        sibling = td.next
+        while sibling is not None and sibling.tag == '-text':
+            sibling = sibling.next
+        if sibling is not None and sibling.tag == 'td' and 'formItem' in (sibling.attributes.get('class') or '').split():
+            return WS_RE.sub(' ', sibling.text()).strip().lower()
+    return ''
+
+
+def parse_drug_detail(html, filename,filepath):
+    html = html.replace('\xa0', ' ')
+    drug_name_match = re.search(r'<h1>Label:.*?id="drug-label">([^<]+)', html, re.DOTALL)
+    if not drug_name_match:
+        return None
+    setid = get_setid(html,filename)
+    
+    drug_name = drug_name_match.group(1).strip() if drug_name_match else None
+    if USE_SELECTOLAX:
+        tree = LexborHTMLParser(html)
+        active_ingredients = extract_table_ingredients_tree(tree, "Active Ingredient/Active Moiety")
+        inactive_ingredients = extract_table_ingredients_tree(tree, "Inactive Ingredients")
+        indications_and_usage = extract_by_section_code_tree(tree, "34067-9")
+        contraindications = extract_by_section_code_tree(tree, "34070-3")
+        warnings = extract_by_section_code_tree(tree, "34071-1")
+        product_type = extract_product_type_tree(tree)
+    else:
+        active_ingredients = extract_table_ingredients(html, "Active Ingredient/Active Moiety")
+        inactive_ingredients = extract_table_ingredients(html, "Inactive Ingredients")
+        indications_and_usage = extract_by_section_code(html, "34067-9")
+        contraindications = extract_by_section_code(html, "34070-3")
+        warnings = extract_by_section_code(html, "34071-1")
+        product_type = extract_product_type(html)
+
+    data = {
+        'setid': setid,
+        'drug_name': drug_name,
+        'product_type': product_type,
+        'active_ingredients': active_ingredients,
+        'inactive_ingredients': inactive_ingredients,
+        'indications_and_usage': indications_and_usage,
+        'contraindications':contraindications,
+        'warnings': warnings,
+        'filepath': filepath
+    }
+
+    return data
+
+
+def parse_file(filepath):
+    with open(filepath, 'r', encoding='utf-8') as f:
+        html = f.read()
+    return parse_drug_detail(html, os.path.basename(filepath), filepath)
+
+
+def parse_page_db(db_path):
+    # the crawler stores one batch of zstd compressed pages per sqlite file
+    dctx = zstandard.ZstdDecompressor()
+    results = []
+    conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+    try:
+        for name, blob in conn.execute("SELECT name, html FROM pages"):
+            html = dctx.decompress(blob).decode('utf-8')
+            data = parse_drug_detail(html, name, f"{db_path}#{name}")
+            if data:
+                results.append(data)
+    finally:
+        conn.close()
+    return results
+
+
+def list_page_dbs(html_dir):
+    with os.scandir(html_dir) as entries:
+        return [entry.path for entry in entries if entry.is_file() and entry.name.endswith('.sqlite')]
+
+
+def list_html_files(html_dir):
+    filepaths = []
+    with os.scandir(html_dir) as batches:
+        for batch in batches:
+            if batch.is_dir():
+                with os.scandir(batch.path) as entries:
+                    filepaths.extend(entry.path for entry in entries if entry.is_file())
+    return filepaths
+
 
 class DailyMedParser:
     def __init__(self,output_dir='data'):
         self.drug_count = 0
         self.output_dir = Path(output_dir)
         self.tsv_path = self.output_dir / 'drugs.tsv'
-        self.tsv_file = open(self.tsv_path, 'w', newline='', encoding='utf-8')
+        self.tsv_file = open(self.tsv_path, 'w', newline='', encoding='utf-8', buffering=1 << 20)
         self.tsv_writer = csv.writer(self.tsv_file, delimiter='\t')
         self.tsv_writer.writerow([
             'setid', 'drug_name',"product_type",'active_ingredients', 'inactive_ingredients','indications_and_usage','contraindications', 'warnings',
@@ -16,133 +243,46 @@ class DailyMedParser:
         ])
         self.parsed = set()
 
-    def extract_text_between(self, html, start_pattern, end_pattern):
-            match = re.search(f'{start_pattern}(.*?){end_pattern}', html, re.DOTALL | re.IGNORECASE)
-            if match:
-                text = match.group(1)
-                text = re.sub(r'<[^>]+>', ' ', text)
-                text = re.sub(r'\s+', ' ', text).strip()
-                return text[:5000]
-            return ''
-
-    def extract_table_ingredients(self, html, heading_text):
-        tables = re.findall(
-            r'<table[^>]*class="formTablePetite"[^>]*>.*?</table>',
-            html, re.DOTALL | re.IGNORECASE
-        )
-
-        table_html = ''
-        for t in tables:
-            if re.search(re.escape(heading_text), t, re.IGNORECASE):
-                table_html = t
-                break
-        if not table_html:
-            return ''
-
-        ingredient_pattern = r'<td class="formItem"><strong>([^<]+)</strong>'
-        ingredients = re.findall(ingredient_pattern, table_html, re.DOTALL | re.IGNORECASE)
-        ingredients = [re.sub(r'\s+', ' ', i.strip()) for i in ingredients]
-
-        if heading_text.lower() == "active ingredient/active moiety".lower():
-            strength_pattern = (
-                r'<td[^>]*class="formItem"[^>]*>\s*'
-                r'((?:\d+(?:[.,]\d+)?[\u00A0\s]*[a-zA-Zμµu]+'
-                r'(?:\s*(?:/|per|in)\s*\d*(?:[.,]\d+)?[\u00A0\s]*[a-zA-Zμµu]*)?)?)'
-                r'\s*</td>'
-            )
-            strengths = re.findall(strength_pattern, table_html, re.DOTALL | re.IGNORECASE)
-            strengths = [re.sub(r'\s+', ' ', s.strip().lower()) for s in strengths if s.strip()]
-
-            combined = []
-            for i, ing in enumerate(ingredients):
-                strength = strengths[i] if i < len(strengths) else ''
-                combined.append(f"{ing} ({strength})" if strength else ing)
-
-            return ', '.join(combined)
-
-        return ', '.join(ingredients)
-    
-
-    def extract_by_section_code(self, html, section_code):
-
-        pattern = rf'<div[^>]*data-sectioncode="{section_code}"[^>]*>(.*?)</div>\s*</li>'
-        match = re.search(pattern, html, re.DOTALL | re.IGNORECASE)
-        if match:
-            text = match.group(1)
-            text = re.sub(r'<[^>]+>', ' ', text) 
-            text = re.sub(r'\s+', ' ', text).strip()
-            return text
-        return ''
-    
-    def get_setid(self, html,filename):
-        file_components = filename.split("_")
-        if "setid" in file_components:
-            setid = file_components[file_components.index("setid")+1]
-            return setid.split(".")[0]
-        else:
-            setid = re.search(r'setid=([0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12})', html)
-            if setid:
-                setid = setid.group(1)
-                return setid
-            
-    def extract_product_type(self, html):
-        pattern = (
-            r'<td[^>]*class="formLabel"[^>]*>\s*Product\s*Type\s*</td>\s*'
-            r'<td[^>]*class="formItem"[^>]*>\s*([^<]+)\s*</td>'
-        )
-        match = re.search(pattern, html, re.DOTALL | re.IGNORECASE)
-        if match:
-            product_type = match.group(1)
-            product_type = re.sub(r'\s+', ' ', product_type).strip().lower()
-            return product_type
-        return ''
-
-    def parse_drug_detail(self, html, filename,filepath):
-        html = html.replace('\xa0', ' ')
-        drug_name_match = re.search(r'<h1>Label:.*?id="drug-label">([^<]+)', html, re.DOTALL)
-        if not drug_name_match:
-            return
-        setid = self.get_setid(html,filename)
-        
-        drug_name = drug_name_match.group(1).strip() if drug_name_match else None
-        active_ingredients = self.extract_table_ingredients(html, "Active Ingredient/Active Moiety")
-        inactive_ingredients = self.extract_table_ingredients(html, "Inactive Ingredients")
-        indications_and_usage = self.extract_by_section_code(html, "34067-9")
-        contraindications = self.extract_by_section_code(html, "34070-3")
-        warnings = self.extract_by_section_code(html, "34071-1")
-        product_type = self.extract_product_type(html)
-
-        data = {
-            'setid': setid,
-            'drug_name': drug_name,
-            'product_type': product_type,
-            'active_ingredients': active_ingredients,
-            'inactive_ingredients': inactive_ingredients,
-            'indications_and_usage': indications_and_usage,
-            'contraindications':contraindications,
-            'warnings': warnings,
-            'filepath': filepath
-        }
-
+    def write_row(self, data):
         self.tsv_writer.writerow(data.values())
         self.drug_count += 1
+
+    def parse_drug_detail(self, html, filename,filepath):
+        data = parse_drug_detail(html, filename, filepath)
+        if data:
+            self.write_row(data)
         return data
     
     def parse_batch(self, batch_name):
         batch_dir = self.output_dir / "html" / batch_name
-        for f in os.listdir(batch_dir):
-            filename = f
-            filepath = batch_dir / filename
-            with open(filepath, 'r', encoding='utf-8') as f:
-                html = f.read()
-                self.parse_drug_detail(html,filename,filepath)
+        with os.scandir(batch_dir) as entries:
+            for entry in entries:
+                if entry.is_file():
+                    with open(entry.path, 'r', encoding='utf-8') as f:
+                        html = f.read()
+                    self.parse_drug_detail(html, entry.name, entry.path)
+
+    def close(self):
+        self.tsv_file.flush()
+        os.fsync(self.tsv_file.fileno())
+        self.tsv_file.close()
             
         
 def main():        
     parser = DailyMedParser()
-    batches = os.listdir("data/html/")
-    for batch in batches:
-        parser.parse_batch(batch)
+    filepaths = list_html_files("data/html")
+    db_paths = list_page_dbs("data/html")
+    try:
+        # workers only parse, rows are written here so the TSV has a single writer
+        with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+            for data in executor.map(parse_file, filepaths, chunksize=64):
+                if data:
+                    parser.write_row(data)
+            for batch in executor.map(parse_page_db, db_paths):
+                for data in batch:
+                    parser.write_row(data)
+    finally:
+        parser.close()
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
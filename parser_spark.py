@@ -1,6 +1,12 @@
 from pyspark.sql import SparkSession
+from pyspark.sql.functions import pandas_udf, col
+from pyspark.sql.types import StructType, StructField, StringType
+import pandas as pd
 import re
 import os
+import glob
+import sqlite3
+import zstandard
 
 spark = (
     SparkSession.builder
@@ -13,7 +19,8 @@ spark = (
     .config("spark.executor.heartbeatInterval", "120s")
     .config("spark.network.timeout", "800s")
     .config("spark.rpc.askTimeout", "600s")
-    .config("spark.sql.execution.arrow.pyspark.enabled", "false")
+    .config("spark.sql.execution.arrow.pyspark.enabled", "true")
+    .config("spark.sql.execution.arrow.maxRecordsPerBatch", "500")
     .config("spark.python.worker.reuse", "true")
     .enableHiveSupport()
     .getOrCreate())
@@ -43,10 +50,9 @@ SECTIONS = {
 TAG_RE = re.compile(r'<[^>]+>')
 WS_RE = re.compile(r'\s+')
 
-def parse_file(filepath):
+def parse_page(content, filepath):
     try:
-        with open(filepath, 'r', encoding='utf-8') as f:
-            html = f.read().replace('\xa0', ' ')
+        html = content.decode('utf-8').replace('\xa0', ' ')
 
         drug_match = DRUG_NAME_RE.search(html)
         if not drug_match:
@@ -105,14 +111,6 @@ def parse_file(filepath):
     except Exception as e:
         return None
 
-import glob
-html_files = glob.glob("data/html/*/*")
-
-files_rdd = spark.sparkContext.parallelize(html_files, numSlices=200)
-parsed_rdd = files_rdd.map(parse_file).filter(lambda x: x is not None)
-
-from pyspark.sql.types import StructType, StructField, StringType
-
 schema = StructType([
     StructField("setid", StringType()),
     StructField("drug_name", StringType()),
@@ -125,6 +123,46 @@ schema = StructType([
     StructField("filepath", StringType())
 ])
 
-drugs_df = spark.createDataFrame(parsed_rdd, schema).dropDuplicates(["setid"])
+EMPTY_ROW = (None,) * len(schema.fields)
+
+@pandas_udf(schema)
+def parse_pages(content: pd.Series, path: pd.Series) -> pd.DataFrame:
+    rows = [parse_page(c, p) or EMPTY_ROW for c, p in zip(content, path)]
+    return pd.DataFrame(rows, columns=schema.fieldNames())
+
+# the crawler stores pages zstd compressed in one sqlite file per batch
+def parse_page_dbs(batches):
+    dctx = zstandard.ZstdDecompressor()
+    for paths in batches:
+        for db_path in paths["path"]:
+            conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+            try:
+                rows = []
+                for name, blob in conn.execute("SELECT name, html FROM pages"):
+                    row = parse_page(dctx.decompress(blob), f"{db_path}#{name}")
+                    if row:
+                        rows.append(row)
+            finally:
+                conn.close()
+            yield pd.DataFrame(rows, columns=schema.fieldNames())
+
+db_paths = sorted(glob.glob(os.path.abspath("data/html/*.sqlite")))
+# explicit schema, the type of an empty path list can't be inferred
+path_schema = StructType([StructField("path", StringType())])
+pages_df = (
+    spark.createDataFrame([(p,) for p in db_paths], path_schema)
+    .repartition(max(len(db_paths), 1))
+    .mapInPandas(parse_page_dbs, schema))
+# batch directories of .html files from older crawls
+if glob.glob("data/html/*/*"):
+    html_df = spark.read.format("binaryFile").load("data/html/*/*")
+    pages_df = pages_df.unionByName(
+        html_df
+        .select(parse_pages(col("content"), col("path")).alias("r"))
+        .select("r.*"))
+drugs_df = (
+    pages_df
+    .filter(col("setid").isNotNull())
+    .dropDuplicates(["setid"]))
 drugs_df.write.mode("overwrite").csv("data/drugs.tsv", sep="\t", header=True)
 print(f"{drugs_df.count()} drugs")
\ No newline at end of file
@@ -1,34 +1,138 @@
 import lucene
 from java.nio.file import Paths
-from java.util import HashMap
+from java.util import HashMap, ArrayList
 from java.lang import Float
 from org.apache.lucene.analysis.standard import StandardAnalyzer
-from org.apache.lucene.document import Document, Field, TextField, StringField, StoredField
-from org.apache.lucene.index import IndexWriter, IndexWriterConfig, DirectoryReader
+from org.apache.lucene.document import Document, Field, TextField, StringField, StoredField, SortedDocValuesField
+from org.apache.lucene.index import MultiTerms, IndexWriter, IndexWriterConfig, DirectoryReader, TieredMergePolicy, ConcurrentMergeScheduler
 from org.apache.lucene.store import FSDirectory
-from org.apache.lucene.search import IndexSearcher
-from org.apache.lucene.queryparser.classic import QueryParser, MultiFieldQueryParser
+from org.apache.lucene.search import SearcherManager, SearcherFactory, BooleanClause
+from org.apache.lucene.search.grouping import GroupingSearch
+from org.apache.lucene.util import BytesRef
+from org.apache.lucene.queryparser.classic import QueryParser
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from query_cache import QueryCache
+from lucene_query import FuzzyTermIndex, QueryParsers, build_fuzzy_query, has_group_field
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pa_csv
+import threading
+import time
 import csv
-import re
+import os
 
 lucene.initVM()
 
-def preprocess_text(text):
-    if not text:
-        return ""
-    text = text.lower()
-    dosage_pattern = r'\d+(?:\.\d+)?\s*(?:mg|mcg|g|ml|ug|iu|units?)\b'
-    dosages = re.findall(dosage_pattern, text)
-    for d in dosages:
-        clean = re.sub(r'\s+', '', d)
-        text = text.replace(d, clean)
-    return text
+INDEX_BATCH_SIZE = 5000
+REFRESH_INTERVAL = 5
+# arrow regexes are RE2, where \s, \d and \b only know ASCII. spell out the
+# unicode classes python's re uses so e.g. "500\xa0mg" still becomes "500mg"
+_UNICODE_SPACE = '[' + ''.join(c for c in map(chr, range(0x3001)) if c.isspace()) + ']'
+# the unit is followed by a non-word char or the end, kept with the third group
+_DOSAGE_GROUPS = (r'(\p{Nd}+(?:\.\p{Nd}+)?)' + _UNICODE_SPACE +
+                  r'*(mg|mcg|g|ml|ug|iu|units?)($|[^\p{L}\p{N}_])')
+
+TEXT_FIELDS = ["drug_name", "active_ingredients", "indications_and_usage",
+               "contraindications", "warnings", "pharmacodynamics",
+               "pharmacokinetics", "medical_uses", "adverse_effects"]
+
+def preprocess_column(column):
+    # lowercase and glue dosages like "10 mg" into "10mg" for a whole arrow column
+    return pc.replace_substring_regex(pc.utf8_lower(column), pattern=_DOSAGE_GROUPS, replacement=r'\1\2\3')
+
+def read_tsv_rows(tsv_path):
+    with open(tsv_path, 'r', encoding='utf-8', newline='') as f:
+        header = next(csv.reader(f, delimiter='\t'))
+    table = pa_csv.read_csv(
+        tsv_path,
+        parse_options=pa_csv.ParseOptions(delimiter='\t', newlines_in_values=True),
+        convert_options=pa_csv.ConvertOptions(column_types={name: pa.string() for name in header}))
+    
+    def column(name, preprocess=False):
+        if name not in table.column_names:
+            return [''] * table.num_rows
+        values = pc.fill_null(table[name], '')
+        if preprocess:
+            values = preprocess_column(values)
+        return values.to_pylist()
+    
+    # rows are (setid, *TEXT_FIELDS, filepath) with the text already preprocessed
+    columns = [column('setid')] + [column(name, True) for name in TEXT_FIELDS] + [column('filepath')]
+    return list(zip(*columns))
 
 class PyLuceneDrugIndexer:
     def __init__(self, index_dir="data/lucene_index"):
         self.index_dir = index_dir
         self.analyzer = StandardAnalyzer()
         self.directory = FSDirectory.open(Paths.get(index_dir))
+        
+        # search fields and boosts are the same for every query, parsers are per thread
+        self.fields = ["drug_name", "active_ingredients", "indications_and_usage", 
+                       "medical_uses", "pharmacodynamics", "pharmacokinetics",
+                       "contraindications", "warnings", "adverse_effects"]
+        
+        self.boosts = HashMap()
+        self.boosts.put("drug_name", Float(5.0))
+        self.boosts.put("active_ingredients", Float(4.0))
+        self.boosts.put("indications_and_usage", Float(4.0))
+        self.boosts.put("medical_uses", Float(4.0))
+        self.boosts.put("pharmacodynamics", Float(1.5))
+        self.boosts.put("pharmacokinetics", Float(1.0))
+        self.boosts.put("contraindications", Float(1.0))
+        self.boosts.put("warnings", Float(1.0))
+        self.boosts.put("adverse_effects", Float(1.0))
+        
+        self.parsers = QueryParsers(self.fields, self.analyzer, self.boosts)
+        
+        # opened on first search, the index may not exist yet
+        self.searcher_manager = None
+        self.searcher_manager_lock = threading.Lock()
+        self.query_cache = QueryCache(maxsize=1024)
+        self.drug_name_terms = None
+    
+    def get_searcher_manager(self):
+        # concurrent first searches must not each open a manager and refresh thread
+        with self.searcher_manager_lock:
+            if self.searcher_manager is None:
+                self.searcher_manager = SearcherManager(self.directory, SearcherFactory())
+                threading.Thread(target=self._refresh_loop, daemon=True).start()
+        return self.searcher_manager
+    
+    def _refresh_loop(self):
+        lucene.getVMEnv().attachCurrentThread()
+        while True:
+            time.sleep(REFRESH_INTERVAL)
+            self.refresh_searcher()
+    
+    def refresh_searcher(self):
+        if not self.searcher_manager.isSearcherCurrent():
+            self.searcher_manager.maybeRefreshBlocking()
+            self.query_cache.invalidate()
+            self.drug_name_terms = None
+    
+    def get_drug_name_terms(self):
+        if self.drug_name_terms is None:
+            self.drug_name_terms = FuzzyTermIndex(self.read_field_terms("drug_name"))
+        return self.drug_name_terms
+    
+    def read_field_terms(self, field):
+        searcher_manager = self.get_searcher_manager()
+        searcher = searcher_manager.acquire()
+        try:
+            terms = MultiTerms.getTerms(searcher.getIndexReader(), field)
+            if terms is None:
+                return []
+            terms_enum = terms.iterator()
+            words = []
+            while True:
+                term = terms_enum.next()
+                if term is None:
+                    break
+                words.append(term.utf8ToString())
+            return words
+        finally:
+            searcher_manager.release(searcher)
     
     def index_exists(self):
         try:
@@ -36,126 +140,152 @@ class PyLuceneDrugIndexer:
             return True
         except:
             return False
+    
+    def index_has_groups(self):
+        reader = DirectoryReader.open(self.directory)
+        try:
+            return has_group_field(reader)
+        finally:
+            reader.close()
         
     def create_index(self, tsv_path):
         config = IndexWriterConfig(self.analyzer)
         config.setOpenMode(IndexWriterConfig.OpenMode.CREATE)
+        # flush segments on RAM pressure instead of doc count
+        config.setRAMBufferSizeMB(512.0)
+        config.setMaxBufferedDocs(IndexWriterConfig.DISABLE_AUTO_FLUSH)
+        config.setUseCompoundFile(False)
+        merge_policy = TieredMergePolicy()
+        merge_policy.setSegmentsPerTier(20.0)
+        config.setMergePolicy(merge_policy)
+        ncpu = os.cpu_count()
+        merge_threads = max(1, ncpu // 2)
+        merge_scheduler = ConcurrentMergeScheduler()
+        merge_scheduler.setMaxMergesAndThreads(merge_threads + 5, merge_threads)
+        config.setMergeScheduler(merge_scheduler)
         writer = IndexWriter(self.directory, config)
         
-        with open(tsv_path, 'r', encoding='utf-8') as f:
-            reader = csv.DictReader(f, delimiter='\t')
-            
-            for i, row in enumerate(reader):
-                doc = Document()
-                doc.add(StringField("setid", row.get('setid', ''), Field.Store.YES))
-                doc.add(TextField("drug_name", preprocess_text(row.get('drug_name', '')), Field.Store.YES))
-                doc.add(TextField("active_ingredients", preprocess_text(row.get('active_ingredients', '')), Field.Store.YES))
-                doc.add(TextField("indications_and_usage", preprocess_text(row.get('indications_and_usage', '')), Field.Store.YES))
-                doc.add(TextField("contraindications", preprocess_text(row.get('contraindications', '')), Field.Store.YES))
-                doc.add(TextField("warnings", preprocess_text(row.get('warnings', '')), Field.Store.YES))
-                doc.add(TextField("pharmacodynamics", preprocess_text(row.get('pharmacodynamics', '')), Field.Store.YES))
-                doc.add(TextField("pharmacokinetics", preprocess_text(row.get('pharmacokinetics', '')), Field.Store.YES))
-                doc.add(TextField("medical_uses", preprocess_text(row.get('medical_uses', '')), Field.Store.YES))
-                doc.add(TextField("adverse_effects", preprocess_text(row.get('adverse_effects', '')), Field.Store.YES))
-                doc.add(StoredField("filepath", row.get('filepath', '')))
-                
-                writer.addDocument(doc)
-                
-                if (i + 1) % 1000 == 0:
-                    print(f"  Indexed {i + 1} drugs...")
+        rows = read_tsv_rows(tsv_path)
+        
+        # rows are split into one shard per thread by setid, the writer is shared
+        shards = [[] for _ in range(ncpu)]
+        for row in rows:
+            shards[hash(row[0]) % ncpu].append(row)
+        
+        self.indexed = 0
+        self.indexed_lock = threading.Lock()
+        with ThreadPoolExecutor(max_workers=ncpu) as executor:
+            list(executor.map(lambda shard: self._index_chunk(writer, shard), shards))
         
         writer.commit()
         writer.close()
-        print(f"\n indexed {i + 1} drugs")
+        if self.searcher_manager is not None:
+            self.refresh_searcher()
+        print(f"\n indexed {self.indexed} drugs")
+    
+    def _index_chunk(self, writer, rows):
+        lucene.getVMEnv().attachCurrentThread()
+        # docs go to lucene in batches to cut down on JNI calls. lucene doesn't
+        # keep documents after addDocuments returns, so each batch slot's
+        # document and fields are reused for the next batch
+        slots = []
+        batch = ArrayList()
+        for row in rows:
+            if batch.size() == len(slots):
+                slots.append(self.new_document_slot())
+            doc, fields = slots[batch.size()]
+            self.fill_document(fields, row)
+            batch.add(doc)
+            if batch.size() >= INDEX_BATCH_SIZE:
+                self._add_batch(writer, batch)
+        if not batch.isEmpty():
+            self._add_batch(writer, batch)
+    
+    def _add_batch(self, writer, batch):
+        writer.addDocuments(batch)
+        with self.indexed_lock:
+            self.indexed += batch.size()
+            print(f"  Indexed {self.indexed} drugs...")
+        batch.clear()
+    
+    def new_document_slot(self):
+        fields = [StringField("setid", "", Field.Store.YES)]
+        fields += [TextField(name, "", Field.Store.YES) for name in TEXT_FIELDS]
+        # doc values for grouping hits by drug name at search time
+        fields.append(SortedDocValuesField("drug_name_group", BytesRef("")))
+        fields.append(StoredField("filepath", ""))
+        doc = Document()
+        for field in fields:
+            doc.add(field)
+        return doc, fields
+    
+    def fill_document(self, fields, row):
+        # fields are in new_document_slot order: setid, *TEXT_FIELDS, drug_name_group, filepath
+        setid, *texts, filepath = row
+        fields[0].setStringValue(setid)
+        for field, text in zip(fields[1:-2], texts):
+            field.setStringValue(text)
+        fields[-2].setBytesValue(BytesRef(texts[0]))
+        fields[-1].setStringValue(filepath)
     
     def multi_field_search_fuzzy(self, query_str, top_k=15):
-        reader = DirectoryReader.open(self.directory)
-        searcher = IndexSearcher(reader)
-        stored_fields = reader.storedFields()
-        
-        fields = ["drug_name", "active_ingredients", "indications_and_usage", 
-                  "medical_uses", "pharmacodynamics", "pharmacokinetics",
-                  "contraindications", "warnings", "adverse_effects"]
-        
-        boosts = HashMap()
-        boosts.put("drug_name", Float(5.0))
-        boosts.put("active_ingredients", Float(4.0))
-        boosts.put("indications_and_usage", Float(4.0))
-        boosts.put("medical_uses", Float(4.0))
-        boosts.put("pharmacodynamics", Float(1.5))
-        boosts.put("pharmacokinetics", Float(1.0))
-        boosts.put("contraindications", Float(1.0))
-        boosts.put("warnings", Float(1.0))
-        boosts.put("adverse_effects", Float(1.0))
-        
-        parser = MultiFieldQueryParser(fields, self.analyzer, boosts)
-        parser.setDefaultOperator(QueryParser.Operator.AND)
-        parser.setFuzzyMinSim(0.7)
+        return self.query_cache.get(('fuzzy', query_str, top_k),
+                                    lambda: self._multi_field_search_fuzzy(query_str, top_k))
+    
+    def _multi_field_search_fuzzy(self, query_str, top_k):
+        query = build_fuzzy_query(self.analyzer, query_str, self.fields, self.boosts, BooleanClause.Occur.MUST,
+                                  name_terms=self.get_drug_name_terms())
         
+        searcher_manager = self.get_searcher_manager()
+        searcher = searcher_manager.acquire()
         try:
-            fuzzy_query = ' '.join([f"{term}~" for term in query_str.split()])
-            query = QueryParser.parse(parser, fuzzy_query)
-        except:
-            parser.setDefaultOperator(QueryParser.Operator.OR)
-            query = QueryParser.parse(parser, fuzzy_query)
-        
-        hits = searcher.search(query, top_k).scoreDocs
-        
-        results = []
-        for hit in hits:
-            doc = stored_fields.document(hit.doc)
-            results.append({
-                'score': hit.score,
-                'drug_name': doc.get('drug_name'),
-                'active_ingredients': doc.get('active_ingredients'),
-                'indications': doc.get('indications_and_usage')[:200] if doc.get('indications_and_usage') else ''
-            })
-        
-        reader.close()
+            # one hit per drug name, grouped inside lucene
+            groups = GroupingSearch("drug_name_group").search(searcher, query, 0, top_k).groups
+            hits = [group.scoreDocs[0] for group in groups]
+            stored_fields = searcher.getIndexReader().storedFields()
+            
+            results = []
+            for hit in hits:
+                doc = stored_fields.document(hit.doc)
+                results.append({
+                    'score': hit.score,
+                    'drug_name': doc.get('drug_name'),
+                    'active_ingredients': doc.get('active_ingredients'),
+                    'indications': doc.get('indications_and_usage')[:200] if doc.get('indications_and_usage') else ''
+                })
+        finally:
+            searcher_manager.release(searcher)
         return results
     
     def multi_field_search(self, query_str, top_k=15):
-        reader = DirectoryReader.open(self.directory)
-        searcher = IndexSearcher(reader)
-        stored_fields = reader.storedFields()
-        
-        fields = ["drug_name", "active_ingredients", "indications_and_usage", 
-                  "medical_uses", "pharmacodynamics", "pharmacokinetics",
-                  "contraindications", "warnings", "adverse_effects"]
-        
-        boosts = HashMap()
-        boosts.put("drug_name", Float(5.0))
-        boosts.put("active_ingredients", Float(4.0))
-        boosts.put("indications_and_usage", Float(4.0))
-        boosts.put("medical_uses", Float(4.0))
-        boosts.put("pharmacodynamics", Float(1.5))
-        boosts.put("pharmacokinetics", Float(1.0))
-        boosts.put("contraindications", Float(1.0))
-        boosts.put("warnings", Float(1.0))
-        boosts.put("adverse_effects", Float(1.0))
-        
-        parser = MultiFieldQueryParser(fields, self.analyzer, boosts)
-        parser.setDefaultOperator(QueryParser.Operator.AND)
-        
+        return self.query_cache.get(('standard', query_str, top_k),
+                                    lambda: self._multi_field_search(query_str, top_k))
+    
+    def _multi_field_search(self, query_str, top_k):
         try:
-            query = QueryParser.parse(parser, query_str)
+            query = QueryParser.parse(self.parsers.and_parser, query_str)
         except:
-            parser.setDefaultOperator(QueryParser.Operator.OR)
-            query = QueryParser.parse(parser, query_str)
+            query = QueryParser.parse(self.parsers.or_parser, query_str)
         
-        hits = searcher.search(query, top_k).scoreDocs
-        
-        results = []
-        for hit in hits:
-            doc = stored_fields.document(hit.doc)
-            results.append({
-                'score': hit.score,
-                'drug_name': doc.get('drug_name'),
-                'active_ingredients': doc.get('active_ingredients'),
-                'indications': doc.get('indications_and_usage')[:200] if doc.get('indications_and_usage') else ''
-            })
-        
-        reader.close()
+        searcher_manager = self.get_searcher_manager()
+        searcher = searcher_manager.acquire()
+        try:
+            # one hit per drug name, grouped inside lucene
+            groups = GroupingSearch("drug_name_group").search(searcher, query, 0, top_k).groups
+            hits = [group.scoreDocs[0] for group in groups]
+            stored_fields = searcher.getIndexReader().storedFields()
+            
+            results = []
+            for hit in hits:
+                doc = stored_fields.document(hit.doc)
+                results.append({
+                    'score': hit.score,
+                    'drug_name': doc.get('drug_name'),
+                    'active_ingredients': doc.get('active_ingredients'),
+                    'indications': doc.get('indications_and_usage')[:200] if doc.get('indications_and_usage') else ''
+                })
+        finally:
+            searcher_manager.release(searcher)
         return results
 
 
@@ -164,40 +294,21 @@ def compare_query(old_indexer, new_indexer, query, top_k=5):
     print("===============")
     
     print("\nOLD TF-IDF INDEX")
-    old_results = old_indexer.search(query, top_k=50)
-    seen_old = set()
-    count = 0
-    for r in old_results:
-        if r['drug_name'] not in seen_old:
-            seen_old.add(r['drug_name'])
-            count += 1
-            print(f"{count}. {r['drug_name']} (score: {r['score']:.4f})")
-            if count >= top_k:
-                break
+    # first (best scoring) result per drug name
+    old_results = {}
+    for r in old_indexer.search(query, top_k=50):
+        old_results.setdefault(r['drug_name'], r)
+    for count, r in enumerate(islice(old_results.values(), top_k), 1):
+        print(f"{count}. {r['drug_name']} (score: {r['score']:.4f})")
     
+    # pylucene results are already grouped by drug name
     print("\nPYLUCENE INDEX - Standard")
-    new_results = new_indexer.multi_field_search(query, top_k=50)
-    seen_new = set()
-    count = 0
-    for r in new_results:
-        if r['drug_name'] not in seen_new:
-            seen_new.add(r['drug_name'])
-            count += 1
-            print(f"{count}. {r['drug_name']} (score: {r['score']:.4f})")
-            if count >= top_k:
-                break
+    for count, r in enumerate(new_indexer.multi_field_search(query, top_k=top_k), 1):
+        print(f"{count}. {r['drug_name']} (score: {r['score']:.4f})")
     
     print("\nPYLUCENE INDEX - Fuzzy AND")
-    fuzzy_results = new_indexer.multi_field_search_fuzzy(query, top_k=50)
-    seen_fuzzy = set()
-    count = 0
-    for r in fuzzy_results:
-        if r['drug_name'] not in seen_fuzzy:
-            seen_fuzzy.add(r['drug_name'])
-            count += 1
-            print(f"{count}. {r['drug_name']} (score: {r['score']:.4f})")
-            if count >= top_k:
-                break
+    for count, r in enumerate(new_indexer.multi_field_search_fuzzy(query, top_k=top_k), 1):
+        print(f"{count}. {r['drug_name']} (score: {r['score']:.4f})")
 
 
 def compare_multiple_queries(old_indexer, new_indexer, queries):
@@ -209,16 +320,19 @@ def compare_multiple_queries(old_indexer, new_indexer, queries):
 def main():
     pylucene_indexer = PyLuceneDrugIndexer()
     
-    if pylucene_indexer.index_exists():
-        print("index exists, loading..")
-    else:
+    if not pylucene_indexer.index_exists():
         print("creating pylucene index..")
         pylucene_indexer.create_index('data/wiki_drugs.tsv')
+    elif not pylucene_indexer.index_has_groups():
+        print("index has no drug_name_group doc values, rebuilding..")
+        pylucene_indexer.create_index('data/wiki_drugs.tsv')
+    else:
+        print("index exists, loading..")
 
     from indexer import DrugTFIDFIndexer
     from search_engine import DrugSearchEngine
     old_indexer = DrugTFIDFIndexer()
-    old_indexer.load_index('data/drug_index.json')
+    old_indexer.load_index('data/drug_index.msgpack.zst')
     old_search = DrugSearchEngine(old_indexer)
 
     test_queries = [
@@ -0,0 +1,43 @@
+from cachetools import LRUCache
+import threading
+
+
+class QueryCache:
+    def __init__(self, maxsize=1024):
+        self.cache = LRUCache(maxsize=maxsize)
+        self.lock = threading.Lock()
+        # bumped when the index changes so old results are never served
+        self.version = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, compute):
+        with self.lock:
+            key = (self.version,) + key
+            results = self.cache.get(key)
+            if results is not None:
+                self.hits += 1
+                return list(results)
+            self.misses += 1
+
+        # search outside the lock, a duplicate miss only costs one extra search
+        results = tuple(compute())
+        with self.lock:
+            self.cache[key] = results
+        return list(results)
+
+    def invalidate(self):
+        with self.lock:
+            self.version += 1
+            self.cache.clear()
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / total if total else 0.0,
+                'size': len(self.cache),
+                'version': self.version
+            }
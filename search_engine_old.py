@@ -1,31 +1,76 @@
 import math
-from collections import defaultdict
+from collections import Counter
+import numpy as np
 from indexer import DrugTFIDFIndexer
 
+# idf is scored as int16 fixed point, 2048 steps per unit
+IDF_SCALE = 2048
+
 class IDFCalculator:
     
-    def __init__(self, index, doc_count):
-        self.index = index
+    def __init__(self, indexer, doc_count):
+        self.indexer = indexer
         self.N = doc_count
+        # the tf matrix the vectors were computed from
+        self.tf = None
+        self.refresh()
+    
+    def refresh(self):
+        # finalize() swaps in a new matrix whenever documents were added, new
+        # term ids would run past the vectors and df would be stale
+        self.indexer.finalize()
+        if self.indexer.tf is self.tf:
+            return
+        if self.tf is not None:
+            self.N = self.indexer.doc_count
+        self.tf = self.indexer.tf
+        self.idf_vectors = self.compute_idf_vectors()
+        self.quantized_idf_vectors = {
+            method: np.clip(np.rint(idf * IDF_SCALE), -32767, 32767).astype(np.int16)
+            for method, idf in self.idf_vectors.items()
+        }
+    
+    def compute_idf_vectors(self):
+        # all four idf variants for every term in the vocab, indexed by term id
+        self.indexer.finalize()
+        N = float(self.N)
+        df = np.diff(self.indexer.tf.indptr).astype(np.float64)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            standard = np.where(df > 0, np.log(N / df), 0.0)
+            smooth = np.log(N / (df + 1))
+            probabilistic = np.where((df > 0) & (df < N), np.log((N - df) / df), 0.0)
+            bm25 = np.log((N - df + 0.5) / (df + 0.5))
+        return {
+            'standard': standard,
+            'smooth': smooth,
+            'probabilistic': probabilistic,
+            'bm25': bm25
+        }
+    
+    def idf_vector(self, idf_method):
+        return self.idf_vectors.get(idf_method, self.idf_vectors['standard'])
+    
+    def quantized_idf_vector(self, idf_method):
+        return self.quantized_idf_vectors.get(idf_method, self.quantized_idf_vectors['standard'])
     
     def standard_idf(self, term):
-        df = len(self.index.get(term, {}))
+        df = self.indexer.document_frequency(term)
         if df == 0:
             return 0
         return math.log(self.N / df)
     
     def smooth_idf(self, term):
-        df = len(self.index.get(term, {}))
+        df = self.indexer.document_frequency(term)
         return math.log(self.N / (df + 1))
     
     def probabilistic_idf(self, term):
-        df = len(self.index.get(term, {}))
+        df = self.indexer.document_frequency(term)
         if df == 0 or df == self.N:
             return 0
         return math.log((self.N - df) / df)
     
     def bm25_idf(self, term):
-        df = len(self.index.get(term, {}))
+        df = self.indexer.document_frequency(term)
         return math.log((self.N - df + 0.5) / (df + 0.5))
 
 
@@ -33,7 +78,10 @@ class DrugSearchEngine:
     
     def __init__(self, indexer):
         self.indexer = indexer
-        self.idf_calc = IDFCalculator(indexer.index, indexer.doc_count)
+        self.idf_calc = IDFCalculator(indexer, indexer.doc_count)
+        # per-doc score buffers, reused across searches and cleared after each one
+        self.scores = np.zeros(0, dtype=np.int64)
+        self.matched = np.zeros(0, dtype=np.int32)
     
     def search(self, query, idf_method='standard', top_k=10):
 
@@ -42,47 +90,62 @@ class DrugSearchEngine:
         if not query_terms:
             return []
         
-        doc_term_counts = defaultdict(int)
-        scores = defaultdict(float)
-
-        for term in query_terms:
-            if term not in self.indexer.index:
-                continue
+        # repeated query terms count once per occurrence
+        term_counts = Counter(t for t in query_terms if t in self.indexer.vocab)
+        if not term_counts:
+            return []
 
-            if idf_method == 'standard':
-                idf = self.idf_calc.standard_idf(term)
-            elif idf_method == 'smooth':
-                idf = self.idf_calc.smooth_idf(term)
-            elif idf_method == 'probabilistic':
-                idf = self.idf_calc.probabilistic_idf(term)
-            elif idf_method == 'bm25':
-                idf = self.idf_calc.bm25_idf(term)
-            else:
-                idf = self.idf_calc.standard_idf(term)
+        rows = np.fromiter((self.indexer.vocab[t] for t in term_counts), dtype=np.int64, count=len(term_counts))
+        counts = np.fromiter(term_counts.values(), dtype=np.int64, count=len(term_counts))
+        self.idf_calc.refresh()
+        # uint8 tf times int16 idf, summed in int64 so it can't overflow
+        weights = counts * self.idf_calc.quantized_idf_vector(idf_method)[rows].astype(np.int64)
 
-            for doc_id, tf in self.indexer.index[term].items():
-                scores[doc_id] += tf * idf
-                doc_term_counts[doc_id] += 1
+        # walk each query term's posting slice straight out of the csr arrays
+        tf = self.indexer.tf
+        if self.scores.size != tf.shape[1]:
+            self.scores = np.zeros(tf.shape[1], dtype=np.int64)
+            self.matched = np.zeros(tf.shape[1], dtype=np.int32)
+        scores = self.scores
+        matched = self.matched
+        touched = []
+        for row, weight in zip(rows.tolist(), weights):
+            start, end = tf.indptr[row], tf.indptr[row + 1]
+            # doc ids are unique within a posting list so plain fancy adds are safe
+            doc_idxs = tf.indices[start:end]
+            # widen the uint8 counts first, numpy 1.x value-based casting would
+            # otherwise keep the product in uint8 and wrap
+            scores[doc_idxs] += tf.data[start:end].astype(np.int64) * weight
+            matched[doc_idxs] += 1
+            touched.append(doc_idxs)
 
-        num_query_terms = len([t for t in query_terms if t in self.indexer.index])
-        
-        filtered_scores = {
-            doc_id: score 
-            for doc_id, score in scores.items() 
-            if doc_term_counts[doc_id] == num_query_terms
-        }
-        
-        if not filtered_scores:
+        # only docs containing every query term are kept, every one of them is
+        # in the first term's postings
+        first = touched[0]
+        candidates = first[matched[first] == len(rows)]
+        candidate_scores = scores[candidates]
+        for doc_idxs in touched:
+            scores[doc_idxs] = 0
+            matched[doc_idxs] = 0
+        if not candidates.size:
             return []
 
-        ranked = sorted(filtered_scores.items(), key=lambda x: x[1], reverse=True)[:top_k]
+        if candidates.size > top_k:
+            # keep everything tied with the k-th score so ties rank like a full sort
+            kth = np.partition(candidate_scores, -top_k)[-top_k]
+            keep = candidate_scores >= kth
+            candidates = candidates[keep]
+            candidate_scores = candidate_scores[keep]
+        order = np.argsort(-candidate_scores, kind='stable')[:top_k]
+        ranked = zip(candidates[order].tolist(), candidate_scores[order].tolist())
         
         results = []
-        for doc_id, score in ranked:
+        for doc_idx, score in ranked:
+            doc_id = self.indexer.doc_ids[doc_idx]
             drug = self.indexer.drugs[doc_id]
             results.append({
                 'setid': doc_id,
-                'score': score,
+                'score': score / IDF_SCALE,
                 'drug_name': drug['drug_name'],
                 'indications': drug['indications_and_usage'][:200] + '...',
                 'active_ingredients': drug['active_ingredients']
@@ -99,31 +162,25 @@ class DrugSearchEngine:
         for method in methods:
             print(f"\n{method.upper()} IDF:")
             results = self.search(query, idf_method=method, top_k=20)
-            printed_results = {"scores":[],"actives":[]}
+            printed_actives = set()
             print_counter = 1
-            for i, result in enumerate(results, 1):
-                if print_counter <= top_k:
-                    if not printed_results["scores"]:
-                        print(f"  {print_counter}. {result['drug_name']}")
-                        print(f"     Score: {result['score']:.4f}")
-                        print(f"     Active: {result['active_ingredients'][:80]}")
-                        print(f"     Usage: {result['indications'][:150]}")
-                        printed_results["scores"].append(result["score"])
-                        printed_results["actives"].append(result["active_ingredients"])
-                        print_counter += 1
-                    elif (result['score'] not in printed_results["scores"] and result['active_ingredients'] not in  printed_results["actives"]):
-                        print(f"  {print_counter}. {result['drug_name']}")
-                        print(f"     Score: {result['score']:.4f}")
-                        print(f"     Active: {result['active_ingredients'][:80]}")
-                        print(f"     Usage: {result['indications'][:150]}")
-                        printed_results["scores"].append(result["score"])
-                        printed_results["actives"].append(result["active_ingredients"])
-                        print_counter += 1
+            for result in results:
+                if print_counter > top_k:
+                    break
+                # skip results that repeat an already printed active ingredient, fixed
+                # point scores tie for different drugs so they can't identify duplicates
+                if result['active_ingredients'] not in printed_actives:
+                    print(f"  {print_counter}. {result['drug_name']}")
+                    print(f"     Score: {result['score']:.4f}")
+                    print(f"     Active: {result['active_ingredients'][:80]}")
+                    print(f"     Usage: {result['indications'][:150]}")
+                    printed_actives.add(result["active_ingredients"])
+                    print_counter += 1
                     
                     
 def main():
     indexer = DrugTFIDFIndexer()
-    indexer.load_index("data/drug_index.json")
+    indexer.load_index_mmap("data/drug_index")
     search_engine = DrugSearchEngine(indexer)
 
     test_queries = [
@@ -5,17 +5,39 @@ from java.lang import Float
 from org.apache.lucene.analysis.standard import StandardAnalyzer
 from org.apache.lucene.index import DirectoryReader
 from org.apache.lucene.store import FSDirectory
-from org.apache.lucene.search import IndexSearcher
-from org.apache.lucene.queryparser.classic import QueryParser, MultiFieldQueryParser
+from org.apache.lucene.search import IndexSearcher, BooleanClause
+from org.apache.lucene.search.grouping import GroupingSearch
+from org.apache.lucene.queryparser.classic import QueryParser
 import sys
 import readline
+from query_cache import QueryCache
+from lucene_query import QueryParsers, build_fuzzy_query, has_group_field
 
 lucene.initVM()
 
+# anything that is not a quit command is a search query
+QUIT_COMMANDS = {'quit', 'exit', 'q'}
+
 class DrugSearchCLI:
     def __init__(self, index_dir="data/lucene_index"):
         self.analyzer = StandardAnalyzer()
         self.directory = FSDirectory.open(Paths.get(index_dir))
+        # the reader is opened once and never refreshed, so results stay valid
+        self.query_cache = QueryCache(maxsize=1024)
+        
+        # search fields and boosts are the same for every query, parsers are per thread
+        self.fields = ["drug_name", "active_ingredients", "indications_and_usage", 
+                       "medical_uses", "pharmacodynamics", "pharmacokinetics"]
+        
+        self.boosts = HashMap()
+        self.boosts.put("drug_name", Float(5.0))
+        self.boosts.put("active_ingredients", Float(4.0))
+        self.boosts.put("indications_and_usage", Float(4.0))
+        self.boosts.put("medical_uses", Float(4.0))
+        self.boosts.put("pharmacodynamics", Float(1.5))
+        self.boosts.put("pharmacokinetics", Float(1.0))
+        
+        self.parsers = QueryParsers(self.fields, self.analyzer, self.boosts)
         
         try:
             self.reader = DirectoryReader.open(self.directory)
@@ -25,55 +47,43 @@ class DrugSearchCLI:
             print(f"Error: Index not found at {index_dir}")
             print("Please create the index first using pylucene_indexer.py")
             sys.exit(1)
+        if not has_group_field(self.reader):
+            print(f"Error: index at {index_dir} has no drug_name_group doc values")
+            print("Please rebuild the index using pylucene_indexer.py")
+            sys.exit(1)
     
     def search(self, query_str, fuzzy=True, top_k=10):
-        fields = ["drug_name", "active_ingredients", "indications_and_usage", 
-                  "medical_uses", "pharmacodynamics", "pharmacokinetics"]
-        
-        boosts = HashMap()
-        boosts.put("drug_name", Float(5.0))
-        boosts.put("active_ingredients", Float(4.0))
-        boosts.put("indications_and_usage", Float(4.0))
-        boosts.put("medical_uses", Float(4.0))
-        boosts.put("pharmacodynamics", Float(1.5))
-        boosts.put("pharmacokinetics", Float(1.0))
-        
-        
-        parser = MultiFieldQueryParser(fields, self.analyzer, boosts)
-        parser.setDefaultOperator(QueryParser.Operator.AND)
-        
+        return self.query_cache.get((query_str, fuzzy, top_k),
+                                    lambda: self._search(query_str, fuzzy, top_k))
+    
+    def _search(self, query_str, fuzzy, top_k):
         if fuzzy:
-            parser.setFuzzyMinSim(0.7)
-            query_str = ' '.join([f"{term}~" for term in query_str.split()])
+            query = build_fuzzy_query(self.analyzer, query_str, self.fields, self.boosts, BooleanClause.Occur.MUST)
+        else:
+            query = QueryParser.parse(self.parsers.and_parser, query_str)
         
-            query = QueryParser.parse(parser, query_str)
-
-        
-        hits = self.searcher.search(query, top_k * 2).scoreDocs
+        # one hit per drug name, grouped inside lucene
+        grouping = GroupingSearch("drug_name_group")
+        groups = grouping.search(self.searcher, query, 0, top_k).groups
         
         results = []
-        if not hits:
-            parser.setDefaultOperator(QueryParser.Operator.OR)
-            query_or = QueryParser.parse(parser, query_str)
-            hits = self.searcher.search(query_or, top_k * 2).scoreDocs
-        seen = set()
-        for hit in hits:
+        if not groups:
+            if fuzzy:
+                query_or = build_fuzzy_query(self.analyzer, query_str, self.fields, self.boosts, BooleanClause.Occur.SHOULD)
+            else:
+                query_or = QueryParser.parse(self.parsers.or_parser, query_str)
+            groups = grouping.search(self.searcher, query_or, 0, top_k).groups
+        for group in groups:
+            hit = group.scoreDocs[0]
             doc = self.stored_fields.document(hit.doc)
-            drug_name = doc.get('drug_name')
-            
-            if drug_name not in seen:
-                seen.add(drug_name)
-                results.append({
-                    'score': hit.score,
-                    'drug_name': drug_name,
-                    'active_ingredients': doc.get('active_ingredients'),
-                    'indications': doc.get('indications_and_usage'),
-                    'warnings': doc.get('warnings'),
-                    'setid': doc.get('setid')
-                })
-                
-                if len(results) >= top_k:
-                    break
+            results.append({
+                'score': hit.score,
+                'drug_name': doc.get('drug_name'),
+                'active_ingredients': doc.get('active_ingredients'),
+                'indications': doc.get('indications_and_usage'),
+                'warnings': doc.get('warnings'),
+                'setid': doc.get('setid')
+            })
         
         return results
     
@@ -112,22 +122,14 @@ class DrugSearchCLI:
                 if not user_input:
                     continue
                 
-                if user_input.lower() in ['quit', 'exit', 'q']:
+                # split off the command word once, only a lone quit word exits
+                command, _, rest = user_input.partition(' ')
+                if command.lower() in QUIT_COMMANDS and not rest:
                     print("exited")
                     break
                 
-                fuzzy = True
-                show_details = True
-                
-                
-                query = user_input
-                
-                if not query:
-                    print("Please enter a query.")
-                    continue
-                
-                results = self.search(query, fuzzy=fuzzy)
-                self.display_results(results, show_details=show_details)
+                results = self.search(user_input, fuzzy=True)
+                self.display_results(results, show_details=True)
                 
             except KeyboardInterrupt:
                 print("\n\nGoodbye!")